@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+#
+# bench.py drives WTFS directly, without mounting it, to measure how its
+#          tuning options behave under load
+#
+# Every benchmark prints one line per configuration it compares
+
+import argparse
+import os
+import platform
+import re
+import sys
+import tempfile
+import threading
+import time
+
+import wtfs
+
+
+READ_SIZE = 128 * 1024
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def file_paths(fs):
+    return [wtfs.join_path('/', name) for name in fs('readdir', '/', 0)[2:]
+            if not fs('getattr', wtfs.join_path('/', name))['st_mode'] &
+            0o40000]
+
+
+def stream(fs, path, stop, counts):
+    # Read the file front to back until told to stop, wrapping at EOF
+    fh = fs('open', path, 0)
+    offset = 0
+    while not stop.is_set():
+        data = fs('read', path, READ_SIZE, offset, fh)
+        offset = offset + len(data) if data else 0
+        counts.append(len(data))
+    fs('release', path, fh)
+
+
+def bench_metadata_latency(args):
+    # getattr latency while several threads stream Markov generated files,
+    # with rendering in-process and in a process pool
+    for processes in (0, args.processes):
+        fs = wtfs.WTFS(
+            generator=wtfs.MarkovContent(
+                wtfs.SizeDistribution.fixed(args.file_size)),
+            render_processes=processes, prefetch_blocks=0,
+            bulk_concurrency=args.bulk_concurrency)
+        paths = file_paths(fs)
+        stop = threading.Event()
+        counts = []
+        readers = [threading.Thread(target=stream,
+                                    args=(fs, paths[i % len(paths)], stop,
+                                          counts))
+                   for i in range(args.readers)]
+        for reader in readers:
+            reader.start()
+        latencies = []
+        deadline = time.perf_counter() + args.seconds
+        while time.perf_counter() < deadline:
+            # Like a fusepy thread woken by the kernel, the probe has to
+            # win the GIL back after blocking, so that wait is included
+            start = time.perf_counter()
+            time.sleep(0.001)
+            fs('getattr', paths[len(latencies) % len(paths)])
+            latencies.append(time.perf_counter() - start - 0.001)
+        stop.set()
+        for reader in readers:
+            reader.join()
+        fs.destroy('/')
+        print('render_processes={} readers={} bulk_concurrency={} '
+              'getattr p50={:.3f}ms p99={:.3f}ms max={:.3f}ms '
+              'read={:.1f}MB/s'.format(
+                  processes, args.readers, args.bulk_concurrency,
+                  percentile(latencies, 0.5) * 1000,
+                  percentile(latencies, 0.99) * 1000,
+                  max(latencies) * 1000,
+                  sum(counts) / args.seconds / wtfs.MB))
+
+
+def hammer(fs, paths, stop, counts, index):
+    ops = 0
+    while not stop.is_set():
+        path = paths[ops % len(paths)]
+        fs('getattr', path)
+        fs('read', path, 4096, 0, None)
+        ops += 2
+    counts[index] = ops
+
+
+def bench_scaling(args):
+    # getattr and read throughput on warm caches as the number of worker
+    # threads doubles. Run it under a regular and a free-threaded
+    # (python3.13t) interpreter to compare them.
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    fs = wtfs.WTFS(depth=2)
+    paths = file_paths(fs)
+    for path in paths:
+        fs('read', path, 4096, 0, None)
+    threads = 1
+    while threads <= args.threads:
+        stop = threading.Event()
+        counts = [0] * threads
+        workers = [threading.Thread(target=hammer,
+                                    args=(fs, paths, stop, counts, i))
+                   for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for worker in workers:
+            worker.join()
+        print('python={} gil={} threads={} ops={:.0f}/s'.format(
+            platform.python_version(), 'on' if gil else 'off', threads,
+            sum(counts) / args.seconds))
+        threads *= 2
+
+
+def first_ls(state):
+    # Mount, then list the root and stat everything in it like `ls -l`,
+    # then everything below it like `ls -lR`
+    start = time.perf_counter()
+    fs = wtfs.WTFS(depth=3, state=state)
+    fs('init', '/')
+    for name in fs('readdir', '/', 0)[2:]:
+        fs('getattr', wtfs.join_path('/', name))
+    ls = time.perf_counter() - start
+    for _ in fs.walk(fs.epoch):
+        pass
+    ls_r = time.perf_counter() - start
+    fs('destroy', '/')
+    return ls, ls_r
+
+
+def bench_startup(args):
+    # Time to the first listings from nothing, and again after a clean
+    # unmount saved the state. The corpus and its indexes are built once
+    # per process whatever the state, so that is done before timing.
+    wtfs.get_search_index()
+    wtfs.get_trigram_index()
+    with tempfile.TemporaryDirectory() as directory:
+        state = os.path.join(directory, 'state')
+        for start in ('cold', 'warm'):
+            ls, ls_r = first_ls(state)
+            print('start={} state={}KiB ls={:.1f}ms ls-R={:.1f}ms'.format(
+                start, os.path.getsize(state) // 1024, ls * 1000,
+                ls_r * 1000))
+
+
+SEARCH_QUERIES = [
+    ('fgrep', 'money'),
+    ('fgrep', 'you '),
+    ('grep', r'click.*here'),
+    ('grep', r'[0-9]{3}'),
+    ('grep', r'ing\b'),
+]
+
+
+def bench_search(args):
+    # Substring and pattern queries answered by the trigram index through
+    # the search directories, against reading and scanning every file.
+    # Files are read once first, so the scan does not pay for rendering.
+    fs = wtfs.WTFS(depth=2)
+    paths = [path for path, attrs in fs.walk(fs.epoch)
+             if not attrs['st_mode'] & 0o40000]
+    for path in paths:
+        fs('read', path, wtfs.MB, 0, None)
+    # Start the process /.grep patterns run in
+    fs('readdir', '/.grep/warm', 0)
+    for kind, query in SEARCH_QUERIES:
+        start = time.perf_counter()
+        # Also clear the query cache, so the index is really probed
+        wtfs.find_substring.cache_clear()
+        wtfs.find_pattern.cache_clear()
+        indexed = fs('readdir', '/.{}/{}'.format(kind, query), 0)[2:]
+        index_time = time.perf_counter() - start
+        regex = re.compile(re.escape(query) if kind == 'fgrep' else query,
+                           re.IGNORECASE)
+        start = time.perf_counter()
+        scanned = [path[1:].replace('/', '.') for path in paths
+                   if regex.search(fs('read', path, wtfs.MB, 0, None)
+                                   .decode('utf-8'))]
+        scan_time = time.perf_counter() - start
+        print('{}={!r} files={} matches={} index={:.3f}ms scan={:.3f}ms '
+              'same={}'.format(kind, query, len(paths), len(indexed),
+                               index_time * 1000, scan_time * 1000,
+                               indexed == sorted(scanned)))
+    fs.destroy('/')
+
+
+BENCHMARKS = {
+    'metadata-latency': bench_metadata_latency,
+    'scaling': bench_scaling,
+    'search': bench_search,
+    'startup': bench_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--file-size', type=int, default=wtfs.GB)
+    parser.add_argument('--bulk-concurrency', type=int,
+                        default=wtfs.BULK_CONCURRENCY)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
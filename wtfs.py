@@ -8,33 +8,413 @@
 # The word list used to generate the filenames and the spam messages
 # are included directly in this file
 
+import argparse
+import array
+import bisect
 import codecs
+import collections
+import concurrent.futures
+import errno
+import functools
+import gzip
 import hashlib
+import heapq
+import json
+import marshal
+import math
+import mmap
+import multiprocessing
+import os
+import queue
 import random
+import re
+import shutil
 import stat
+import struct
 import sys
+import tarfile
+import threading
 import time
+import zlib
+from multiprocessing import shared_memory
 
-from fuse import FUSE, Operations
+from fuse import FUSE, FuseOSError, Operations
 
 
 DIR_ENTRY_RANGE = (8, 20)
 REGEN_CONTENTS_TIMEOUT = 3 # seconds
+SLOW_OP_THRESHOLD = 0.1 # seconds
+SLOW_OP_LOG_SIZE = 256
+HOT_PATHS_CAPACITY = 256
+HOT_PATHS_SHOWN = 32
+CONTENT_CACHE_BYTES = 64 * 1024 * 1024
+CACHE_SHARDS = 16 # independently locked parts of each cache
+TREE_DEPTH = 0 # levels of subdirectories below the root
+TREE_FANOUT = 4 # subdirectories per directory
+LISTING_CACHE_SIZE = 4096 # directories
+HISTORY_DIR = '/.history'
+HISTORY_EPOCHS = 64 # recent epochs listed in /.history
+HISTORY_LISTING_CACHE_SIZE = 1024 # directories of past epochs
+CHANGES_EPOCHS = 16 # regenerations reported by /.changes
+SEARCH_DIR = '/.search'
+FGREP_DIR = '/.fgrep'
+GREP_DIR = '/.grep'
+QUERY_CACHE_SIZE = 256 # substring and pattern results kept
+GREP_MAX_PATTERN = 256 # characters in a /.grep pattern
+GREP_TIMEOUT = 5 # seconds a pattern may run over the corpus
+MANIFEST_NAME = '.manifest'
+MANIFEST_CACHE_SIZE = 256 # directories with line offsets kept
+CHECKSUM_CACHE_SIZE = 64 * 1024 # contents with a CRC32 kept
+XATTR_PREFIX = 'user.wtfs.'
+CHECKSUM_MAX_SIZE = 1024 * 1024 # largest file given a CRC32
+BLOCK_SIZE = 64 * 1024
+LARGE_FILE_SIZE = 1024 * 1024 * 1024
+CORPUS_RUN = 512 # bytes copied from the corpus per random pick
+MARKOV_ORDER = 2 # words of context
+MARKOV_SEGMENT_BLOCKS = 16 # the chain restarts every this many blocks
+MARKOV_CHECKPOINTS = 64 * 1024
+PREFETCH_BLOCKS = 4 # read-ahead window per sequential handle
+PREFETCH_BUDGET = 32 # blocks being prefetched across all handles
+PREFETCH_WORKERS = 2
+SEQUENTIAL_READS = 2 # back-to-back reads before read-ahead starts
+RENDER_SLOTS_PER_PROCESS = 2 # shared memory blocks per render process
+BULK_CONCURRENCY = 2 # reads rendering blocks at once
+BULK_QUEUE_DEPTH = 64 # waiting reads past which waits count as overflow
+GZIP_MAX_SIZE = 1024 * 1024 # largest file given a .gz twin
+TAR_BUFFER_SIZE = 64 * 1024 # tarfile gets slower with larger buffers
+MATERIALIZE_WORKERS = 8
+MATERIALIZE_BATCH = 64 # files handed to a writer at once
+WRITE_BUFFER_SIZE = 1024 * 1024 # bytes gathered per os.write
+REPORT_INTERVAL = 5 # seconds between progress lines
+TMPFS_WORKERS = 2 # writers filling the tmpfs copy of a new epoch
+TMPFS_DESTROY_TIMEOUT = 10 # seconds unmount waits for a copy to finish
+TMPFS_MAX_BYTES = 256 * 1024 * 1024 # largest epoch copied to the tmpfs
+TMPFS_MAX_FILES = 64 * 1024 # most files an epoch copied to the tmpfs has
+BLOCK_CACHE_BYTES = 256 * 1024 * 1024
+BLOCK_CACHE_SLOT_SIZE = BLOCK_SIZE
+BLOCK_CACHE_WAYS = 4 # slots a key may occupy
+STATE_MAGIC = b'WTFSST02'
 
 
 def get_index(path):
-    return path.__hash__() % len(SPAMS)
+    # A stable hash, so a path keeps its contents across restarts and
+    # persisted caches stay valid
+    return zlib.crc32(path.encode('utf-8')) % len(SPAMS)
 
 
-def get_spam(path):
+def render_spam(index):
+    return get_decoded_spams()[index]
+
+
+@functools.lru_cache(maxsize=None)
+def get_decoded_spams():
+    # Decoded once into an immutable tuple, so threads share it without
+    # any locking
     rot13 = codecs.getencoder('rot-13')
-    index = get_index(path)
-    # Fortune gives you the files in rot13 for some reason
-    spam = rot13(SPAMS[index])[0]
-    # First two lines are always "Today's Spam:" and a newline
-    # so trim those and the final trailing newline
-    spam_text = "\n".join(spam.split('\n')[2:])
-    return spam_text
+    spams = []
+    for spam in SPAMS:
+        # Fortune gives you the files in rot13 for some reason
+        spam = rot13(spam)[0]
+        # First two lines are always "Today's Spam:" and a newline
+        # so trim those and the final trailing newline
+        spams.append("\n".join(spam.split('\n')[2:]))
+    return tuple(spams)
+
+
+@functools.lru_cache(maxsize=None)
+def get_corpus():
+    # Every decoded spam and every word, as one buffer to copy runs from
+    spams = '\n'.join(render_spam(i) for i in range(len(SPAMS)))
+    words = ' '.join(WORDS)
+    return (spams + '\n' + words + '\n').encode('utf-8')
+
+
+@functools.lru_cache(maxsize=None)
+def get_search_index():
+    # Lowercased token to the corpus indexes of the spams containing it.
+    # Underscores split tokens, since some spams use them for spaces.
+    postings = collections.defaultdict(set)
+    for index, spam in enumerate(get_decoded_spams()):
+        for token in re.findall(r'[^\W_]+', spam.lower()):
+            postings[token].add(index)
+    return {token: frozenset(indexes) for token, indexes in postings.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def get_lowered_spams():
+    return tuple(spam.lower() for spam in get_decoded_spams())
+
+
+@functools.lru_cache(maxsize=None)
+def get_trigram_index():
+    # Every trigram of the lowercased corpus to an array of the indexes
+    # of the spams containing it. Indexes are appended in order, so each
+    # array is sorted.
+    postings = collections.defaultdict(lambda: array.array('I'))
+    for index, spam in enumerate(get_lowered_spams()):
+        for trigram in {spam[i:i+3] for i in range(len(spam) - 2)}:
+            postings[trigram].append(index)
+    return dict(postings)
+
+
+def intersect_sorted(a, b):
+    result = array.array('I')
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            result.append(a[i])
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def trigram_candidates(literals):
+    # Indexes of the spams holding every trigram of every lowercased
+    # literal, or all of them if no literal is long enough to narrow
+    # them down. Shortest posting lists are intersected first.
+    index = get_trigram_index()
+    trigrams = {literal[i:i+3]
+                for literal in literals for i in range(len(literal) - 2)}
+    if not trigrams:
+        return range(len(SPAMS))
+    postings = sorted((index.get(trigram, array.array('I'))
+                       for trigram in trigrams), key=len)
+    candidates = postings[0]
+    for other in postings[1:]:
+        if not candidates:
+            break
+        candidates = intersect_sorted(candidates, other)
+    return candidates
+
+
+def skip_class(pattern, start):
+    # Index just past the character class opening at start. A ] first in
+    # it is a member, not the end, and so is an escaped one.
+    end = start + 1
+    if pattern[end:end+1] == '^':
+        end += 1
+    if pattern[end:end+1] == ']':
+        end += 1
+    while end < len(pattern) and pattern[end] != ']':
+        end += 2 if pattern[end] == '\\' else 1
+    return end + 1
+
+
+def check_pattern(pattern):
+    # Refuses patterns that can backtrack for ages: long ones, and ones
+    # repeating a group that itself repeats or alternates, like (a+)+
+    if len(pattern) > GREP_MAX_PATTERN:
+        raise re.error('pattern too long')
+    # Per open group, whether anything in it repeats or alternates
+    groups = [False]
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            i += 2
+            continue
+        if char == '[':
+            i = skip_class(pattern, i)
+            continue
+        if char == '(':
+            groups.append(False)
+        elif char == ')' and len(groups) > 1:
+            repeats = groups.pop()
+            if repeats and pattern[i+1:i+2] in ('*', '+', '{'):
+                raise re.error('nested repeat')
+            groups[-1] = groups[-1] or repeats
+        elif char in '*+{|' or (char == '?' and pattern[i-1:i] != '('):
+            groups[-1] = True
+        i += 1
+
+
+def grep_spams(pattern, candidates):
+    # The candidates a pattern matches, ignoring case. Runs in the
+    # PatternSearcher's worker process.
+    regex = re.compile(pattern, re.IGNORECASE)
+    spams = get_decoded_spams()
+    return [index for index in candidates if regex.search(spams[index])]
+
+
+def regex_literals(pattern):
+    # Runs of plain characters that every match of the pattern contains.
+    # Only the top level outside groups and classes is looked at, and
+    # alternation or inline flags give up, so requiring them is safe.
+    if '|' in pattern or '(?' in pattern:
+        return []
+    literals = []
+    run = ''
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        literal = None
+        if char == '\\':
+            escaped = pattern[i+1:i+2]
+            if escaped in ('x', 'u', 'U', 'N') or escaped.isdigit():
+                # Character codes and backreferences span a varying
+                # number of characters, so there is nothing safe to take
+                return []
+            if escaped and not escaped.isalnum():
+                literal = escaped
+            i += 2
+        elif char == '[':
+            i = skip_class(pattern, i)
+        elif char == '{':
+            # A repeat count, not text
+            end = pattern.find('}', i)
+            i = len(pattern) if end < 0 else end + 1
+        else:
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+            elif char not in '.^$*+?}' and depth == 0:
+                literal = char
+            i += 1
+        quantifier = pattern[i:i+1]
+        if literal is not None and quantifier not in ('*', '?', '{'):
+            run += literal
+            if quantifier != '+':
+                continue
+        if run:
+            literals.append(run)
+        run = ''
+    if run:
+        literals.append(run)
+    return literals
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def find_substring(text):
+    # Indexes of the spams containing text, ignoring case
+    text = text.lower()
+    spams = get_lowered_spams()
+    return frozenset(index for index in trigram_candidates([text])
+                     if text in spams[index])
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def find_pattern(pattern, search=grep_spams):
+    # Indexes of the spams a regular expression matches, ignoring case.
+    # Raises re.error for a bad or too costly pattern. search runs the
+    # pattern over the candidates, in this process by default.
+    check_pattern(pattern)
+    re.compile(pattern, re.IGNORECASE)
+    literals = [literal.lower() for literal in regex_literals(pattern)]
+    return frozenset(search(pattern, list(trigram_candidates(literals))))
+
+
+def splitmix64(state):
+    # Counter-based PRNG whose whole state is one int, so it is cheap to
+    # checkpoint. Returns the next state and its output.
+    state = (state + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    z = state
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return state, z ^ (z >> 31)
+
+
+class MarkovModel(object):
+    # Order-N word chain trained on the decoded SPAMS. The successors of
+    # state s are targets[offsets[s]:offsets[s + 1]], repeated by
+    # frequency, and next_states holds the state each of them leads to.
+    # Token 0 ends a message and leads back to the start state, 0.
+    def __init__(self, order=MARKOV_ORDER):
+        tokens = {'': 0}
+        state_ids = {}
+        successors = []
+        for index in range(len(SPAMS)):
+            words = re.findall(r'\S+|\n', render_spam(index))
+            sequence = [0] * order + \
+                [tokens.setdefault(word, len(tokens)) for word in words] + [0]
+            for i in range(len(sequence) - order):
+                state = tuple(sequence[i:i + order])
+                if state not in state_ids:
+                    state_ids[state] = len(state_ids)
+                    successors.append([])
+                successors[state_ids[state]].append(sequence[i + order])
+        self.offsets = array.array('I', [0])
+        self.targets = array.array('I')
+        self.next_states = array.array('I')
+        for state, state_id in state_ids.items():
+            for token in successors[state_id]:
+                self.targets.append(token)
+                self.next_states.append(
+                    state_ids[state[1:] + (token,)] if token else 0)
+            self.offsets.append(len(self.targets))
+        self.token_bytes = [b'\n\n'] + [
+            word.encode('utf-8') + (b'' if word == '\n' else b' ')
+            for word in list(tokens)[1:]]
+
+    def generate(self, rng, state, carry, length):
+        # Emit at least length bytes starting from a checkpoint. Returns
+        # exactly length bytes and the checkpoint for the byte after them.
+        offsets = self.offsets
+        targets = self.targets
+        next_states = self.next_states
+        token_bytes = self.token_bytes
+        out = [carry]
+        size = len(carry)
+        while size < length:
+            rng, value = splitmix64(rng)
+            first = offsets[state]
+            choice = first + value % (offsets[state + 1] - first)
+            word = token_bytes[targets[choice]]
+            out.append(word)
+            size += len(word)
+            state = next_states[choice]
+        data = b''.join(out)
+        return data[:length], (rng, state, data[length:])
+
+
+@functools.lru_cache(maxsize=None)
+def get_markov_model(order=MARKOV_ORDER):
+    return MarkovModel(order)
+
+
+def get_dir_entries(path, epoch, entry_range=DIR_ENTRY_RANGE):
+    # The root keeps its original (epoch + i) seeding; subdirectories
+    # prefix the seed with their own path so every directory differs
+    prefix = b'' if path == '/' else path.encode('utf-8')
+    rng = random.Random(prefix + epoch.to_bytes(8, byteorder='little'))
+    names = [get_word(prefix + (epoch + i).to_bytes(8, byteorder='little'))
+             for i in range(rng.randint(*entry_range))]
+    # The word list is small, so drop repeats while keeping the order.
+    # Its blank first and last lines are not usable names.
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def join_path(parent, name):
+    return parent.rstrip('/') + '/' + name
+
+
+def split_path(path):
+    parent, name = path.rsplit('/', 1)
+    return parent or '/', name
+
+
+def diff_sorted(old, new):
+    # (added, removed) between two sorted lists of names, in one merge
+    added, removed = [], []
+    i = j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+        elif old[i] < new[j]:
+            removed.append(old[i])
+            i += 1
+        else:
+            added.append(new[j])
+            j += 1
+    removed.extend(old[i:])
+    added.extend(new[j:])
+    return added, removed
 
 
 def get_word(seed):
@@ -46,60 +426,1945 @@ def get_word(seed):
     return WORDS[index]
 
 
+# A directory listing for one epoch: its entries, which of them are
+# subdirectories, the directory's own stat dict and one per entry name
+Listing = collections.namedtuple(
+    'Listing',
+    ['path', 'epoch', 'dir_contents', 'subdirs', 'dir_attrs', 'attrs'])
+
+# A directory's listing with the offset each manifest line starts at,
+# plus the total length
+Manifest = collections.namedtuple('Manifest', ['listing', 'offsets'])
+
+
+class SlowOpLog(object):
+    # Fixed-size ring of the most recent upcalls that took longer than
+    # the threshold. Slots are preallocated so recording never allocates
+    # beyond the entry tuple itself.
+    def __init__(self, threshold=SLOW_OP_THRESHOLD, size=SLOW_OP_LOG_SIZE):
+        self.threshold = threshold
+        self.__entries = [None] * size
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def record(self, op, args, epoch, duration):
+        path = args[0] if args and isinstance(args[0], str) else ''
+        # Only read carries an offset and length: (path, length, offset, fh)
+        length, offset = args[1:3] if op == 'read' else (None, None)
+        entry = (time.time(), op, path, offset, length,
+                 threading.current_thread().name, epoch, duration)
+        with self.__lock:
+            self.__entries[self.__next % len(self.__entries)] = entry
+            self.__next += 1
+
+    def entries(self):
+        with self.__lock:
+            start = self.__next
+            entries = list(self.__entries)
+        size = len(entries)
+        # Oldest first, skipping slots that were never filled
+        ordered = [entries[(start + i) % size] for i in range(size)]
+        return [entry for entry in ordered if entry is not None]
+
+    def dump(self):
+        lines = []
+        for when, op, path, offset, length, thread, epoch, duration in \
+                self.entries():
+            line = '{} {} {}'.format(
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(when)),
+                op, path)
+            if op == 'read':
+                line += ' offset={} length={}'.format(offset, length)
+            line += ' thread={} epoch={} {:.1f}ms\n'.format(
+                thread, epoch, duration * 1000)
+            lines.append(line)
+        return ''.join(lines).encode('utf-8')
+
+
+class SpaceSaving(object):
+    # Space-saving sketch: at most `capacity` paths are tracked, and an
+    # untracked path evicts the current minimum, inheriting its count as
+    # the error bound. Counts are upper bounds; bytes are only those
+    # served since the path was last admitted.
+    def __init__(self, capacity=HOT_PATHS_CAPACITY):
+        self.capacity = capacity
+        # key -> [count, error, bytes]
+        self.__counters = {}
+        # (count, key) min-heap with stale entries left in place
+        self.__heap = []
+        self.__lock = threading.Lock()
+
+    def add(self, key, nbytes=0):
+        with self.__lock:
+            counter = self.__counters.get(key)
+            if counter is None:
+                if len(self.__counters) < self.capacity:
+                    counter = [0, 0, 0]
+                else:
+                    count = self.__evict_min()
+                    counter = [count, count, 0]
+                self.__counters[key] = counter
+            counter[0] += 1
+            counter[2] += nbytes
+            heapq.heappush(self.__heap, (counter[0], key))
+            if len(self.__heap) > 4 * self.capacity:
+                self.__heap = [(counter[0], key) for key, counter
+                               in self.__counters.items()]
+                heapq.heapify(self.__heap)
+
+    def __evict_min(self):
+        while True:
+            count, key = heapq.heappop(self.__heap)
+            counter = self.__counters.get(key)
+            if counter is not None and counter[0] == count:
+                del self.__counters[key]
+                return count
+
+    def top(self, k=HOT_PATHS_SHOWN):
+        with self.__lock:
+            items = [(key, tuple(counter)) for key, counter
+                     in self.__counters.items()]
+        items.sort(key=lambda item: item[1][0], reverse=True)
+        return items[:k]
+
+
+class HeavyHitters(object):
+    # Space-saving sketches over disjoint shards of the paths, so
+    # concurrent upcalls rarely contend for the same lock. A path always
+    # lands in the same shard, so merging the shards' top lists is exact
+    # with respect to the sketches.
+    def __init__(self, capacity=HOT_PATHS_CAPACITY, shards=CACHE_SHARDS):
+        self.__shards = [SpaceSaving(max(capacity // shards, 1))
+                         for _ in range(shards)]
+
+    def add(self, key, nbytes=0):
+        self.__shards[hash(key) % len(self.__shards)].add(key, nbytes)
+
+    def top(self, k=HOT_PATHS_SHOWN):
+        items = [item for shard in self.__shards for item in shard.top(k)]
+        items.sort(key=lambda item: item[1][0], reverse=True)
+        return items[:k]
+
+    def dump(self):
+        return ''.join(
+            '{} {} {} {}\n'.format(count, error, nbytes, key)
+            for key, (count, error, nbytes) in self.top()
+        ).encode('utf-8')
+
+
+class LRUCache(object):
+    # LRU bounded by the total sizeof() of its values, bytes by default.
+    # For rendered contents, keys identify the content rather than the
+    # path, so every path hashing to the same corpus entry shares one
+    # buffer. Generated contents' keys include the epoch, so entries from
+    # earlier epochs are never hit again and simply fall off the cold end.
+    def __init__(self, budget=CONTENT_CACHE_BYTES, sizeof=len):
+        self.budget = budget
+        self.__sizeof = sizeof
+        self.__entries = collections.OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, render):
+        data = self.lookup(key)
+        if data is None:
+            # Render outside the lock; a concurrent miss on the same key
+            # just renders twice
+            data = render()
+            self.put(key, data)
+        return data
+
+    def lookup(self, key):
+        with self.__lock:
+            data = self.__entries.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if data is None:
+            return
+        size = self.__sizeof(data)
+        if size > self.budget:
+            return
+        with self.__lock:
+            if key not in self.__entries:
+                self.__entries[key] = data
+                self.__size += size
+            while self.__size > self.budget:
+                _, evicted = self.__entries.popitem(last=False)
+                self.__size -= self.__sizeof(evicted)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def items(self):
+        with self.__lock:
+            return list(self.__entries.items())
+
+    def values(self):
+        with self.__lock:
+            return list(self.__entries.values())
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'entries': len(self.__entries),
+                'size': self.__size,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class ShardedLRUCache(object):
+    # LRUCache split by key hash into shards with their own lock and an
+    # equal part of the budget, so threads touching different keys never
+    # wait on each other
+    def __init__(self, budget=CONTENT_CACHE_BYTES, sizeof=len,
+                 shards=CACHE_SHARDS):
+        self.budget = budget
+        self.__shards = [LRUCache(budget // shards, sizeof)
+                         for _ in range(shards)]
+
+    def __shard(self, key):
+        return self.__shards[hash(key) % len(self.__shards)]
+
+    def get(self, key, render):
+        return self.__shard(key).get(key, render)
+
+    def lookup(self, key):
+        return self.__shard(key).lookup(key)
+
+    def put(self, key, data):
+        self.__shard(key).put(key, data)
+
+    def __contains__(self, key):
+        return key in self.__shard(key)
+
+    def items(self):
+        return [item for shard in self.__shards for item in shard.items()]
+
+    def values(self):
+        return [value for shard in self.__shards for value in shard.values()]
+
+    def stats(self):
+        stats = collections.Counter()
+        for shard in self.__shards:
+            stats.update(shard.stats())
+        return dict(stats)
+
+
+class BlockCacheFile(object):
+    # Rendered blocks kept in an mmap'd file so a restarted daemon starts
+    # warm. The file is a page-sized header, an index of (key hash, length,
+    # crc32) entries and as many fixed-size data slots. A key may live in
+    # any of BLOCK_CACHE_WAYS slots picked by its hash, and a full set
+    # overwrites them in turn. A slot whose checksum does not match, from a
+    # torn write or a crash, reads as a miss.
+    MAGIC = b'WTFSBC01'
+    HEADER = struct.Struct('<8sIQ')
+    ENTRY = struct.Struct('<QII')
+
+    def __init__(self, path, size=BLOCK_CACHE_BYTES,
+                 slot_size=BLOCK_CACHE_SLOT_SIZE):
+        self.slot_size = slot_size
+        self.slots = max(size // slot_size, BLOCK_CACHE_WAYS)
+        self.slots -= self.slots % BLOCK_CACHE_WAYS
+        self.__index_offset = mmap.PAGESIZE
+        index_size = self.slots * self.ENTRY.size
+        self.__data_offset = self.__index_offset + \
+            -(-index_size // mmap.PAGESIZE) * mmap.PAGESIZE
+        total = self.__data_offset + self.slots * slot_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != total:
+                os.ftruncate(fd, total)
+            self.__map = mmap.mmap(fd, total)
+        finally:
+            os.close(fd)
+        header = self.HEADER.pack(self.MAGIC, slot_size, self.slots)
+        if self.__map[:self.HEADER.size] != header:
+            # New file or a different geometry: start empty
+            self.__map[self.__index_offset:self.__data_offset] = \
+                bytes(self.__data_offset - self.__index_offset)
+            self.__map[:self.HEADER.size] = header
+        # Counters and victims are kept per lock and only summed by stats()
+        self.__locks = [threading.Lock() for _ in range(CACHE_SHARDS)]
+        self.__next_victims = [0] * len(self.__locks)
+        self.__counts = [collections.Counter() for _ in self.__locks]
+
+    def __locate(self, key):
+        # Hash 0 marks an empty slot, so real hashes are never 0
+        digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8)
+        key_hash = int.from_bytes(digest.digest(), byteorder='little') | 1
+        first = key_hash % (self.slots // BLOCK_CACHE_WAYS) * BLOCK_CACHE_WAYS
+        return key_hash, first, first % len(self.__locks)
+
+    def __entry(self, slot):
+        offset = self.__index_offset + slot * self.ENTRY.size
+        return self.ENTRY.unpack_from(self.__map, offset)
+
+    def lookup(self, key):
+        key_hash, first, shard = self.__locate(key)
+        counts = self.__counts[shard]
+        with self.__locks[shard]:
+            for slot in range(first, first + BLOCK_CACHE_WAYS):
+                entry_hash, length, crc = self.__entry(slot)
+                if entry_hash != key_hash:
+                    continue
+                start = self.__data_offset + slot * self.slot_size
+                data = self.__map[start:start + length]
+                if zlib.crc32(data) == crc:
+                    counts['hits'] += 1
+                    return data
+                counts['corrupt'] += 1
+                break
+            counts['misses'] += 1
+        return None
+
+    def put(self, key, data):
+        if len(data) > self.slot_size:
+            return
+        key_hash, first, shard = self.__locate(key)
+        with self.__locks[shard]:
+            slots = range(first, first + BLOCK_CACHE_WAYS)
+            for slot in slots:
+                if self.__entry(slot)[0] in (key_hash, 0):
+                    break
+            else:
+                self.__next_victims[shard] += 1
+                slot = slots[self.__next_victims[shard] % BLOCK_CACHE_WAYS]
+            offset = self.__index_offset + slot * self.ENTRY.size
+            # Invalidate the entry while the data is rewritten
+            self.ENTRY.pack_into(self.__map, offset, 0, 0, 0)
+            start = self.__data_offset + slot * self.slot_size
+            self.__map[start:start + len(data)] = data
+            self.ENTRY.pack_into(self.__map, offset, key_hash, len(data),
+                                 zlib.crc32(data))
+            self.__counts[shard]['stores'] += 1
+
+    def close(self):
+        self.__map.flush()
+        self.__map.close()
+
+    def stats(self):
+        stats = {'slots': self.slots, 'hits': 0, 'misses': 0, 'stores': 0,
+                 'corrupt': 0}
+        for lock, counts in zip(self.__locks, self.__counts):
+            with lock:
+                for name, count in counts.items():
+                    stats[name] += count
+        return stats
+
+
+class SizeDistribution(object):
+    # File sizes as weighted (weight, min, max) buckets, sampled
+    # log-uniformly within a bucket. A size is a function of the path and
+    # epoch alone, so st_size is known without rendering anything.
+    def __init__(self, buckets):
+        self.buckets = [tuple(bucket) for bucket in buckets]
+        self.__total = sum(weight for weight, _, _ in self.buckets)
+
+    @classmethod
+    def fixed(cls, size):
+        return cls([(1, size, size)])
+
+    def size(self, path, epoch):
+        seed = path.encode('utf-8') + epoch.to_bytes(8, byteorder='little')
+        rng = random.Random(hashlib.md5(seed).digest())
+        pick = rng.uniform(0, self.__total)
+        for weight, low, high in self.buckets:
+            pick -= weight
+            if pick <= 0:
+                break
+        if low == high:
+            return low
+        # Rounded rather than truncated, which would never reach high and
+        # clamped since the float round trip can overshoot either end
+        size = round(math.expm1(rng.uniform(math.log1p(low),
+                                            math.log1p(high))))
+        return min(max(size, low), high)
+
+
+class Handle(object):
+    # Per-open state: the content is pinned to the epoch the file was
+    # opened in, and back-to-back reads are counted to detect streaming.
+    # fd is set when reads are proxied to a materialized copy.
+    __slots__ = ('key', 'next_offset', 'sequential', 'fd')
+
+    def __init__(self, key, fd=None):
+        self.key = key
+        self.next_offset = 0
+        self.sequential = 0
+        self.fd = fd
+
+
+class Prefetcher(object):
+    # Renders blocks ahead of sequential readers on a small pool, straight
+    # into the content cache. At most `budget` blocks are in flight; further
+    # requests are dropped rather than queued.
+    def __init__(self, cache, render, workers=PREFETCH_WORKERS,
+                 budget=PREFETCH_BUDGET):
+        self.__cache = cache
+        self.__render = render
+        self.__budget = budget
+        self.__pool = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix='prefetch')
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        self.issued = 0
+        self.dropped = 0
+        self.waited = 0
+
+    def prefetch(self, key, blocks):
+        for block in blocks:
+            cache_key = (key, block)
+            if cache_key in self.__cache:
+                continue
+            with self.__lock:
+                if cache_key in self.__pending:
+                    continue
+                if len(self.__pending) >= self.__budget:
+                    self.dropped += 1
+                    continue
+                self.issued += 1
+                self.__pending[cache_key] = self.__pool.submit(
+                    self.__fill, cache_key)
+
+    def __fill(self, cache_key):
+        try:
+            self.__cache.get(cache_key, lambda: self.__render(*cache_key))
+        finally:
+            with self.__lock:
+                del self.__pending[cache_key]
+
+    def wait(self, key, block):
+        # A reader that catches up with read-ahead waits for it rather
+        # than rendering the same block again. If the prefetch failed the
+        # reader just renders the block itself.
+        future = self.__pending.get((key, block))
+        if future is not None:
+            with self.__lock:
+                self.waited += 1
+            concurrent.futures.wait([future])
+
+    def shutdown(self):
+        self.__pool.shutdown(wait=False)
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'pending': len(self.__pending),
+                'issued': self.issued,
+                'dropped': self.dropped,
+                'waited': self.waited,
+            }
+
+
+class BulkLane(object):
+    # Work queue for rendering on behalf of reads. At most `concurrency`
+    # renders run at once and the rest wait for a slot. A read(2) of a
+    # regular file is not expected to fail for being busy, so callers
+    # always wait; ones arriving with `depth` already waiting are counted
+    # as overflow to show the lane is too narrow. Metadata upcalls only
+    # enter it for what renders content, a gzip twin's size or a CRC32,
+    # so the rest are never queued behind bulk reads.
+    def __init__(self, concurrency=BULK_CONCURRENCY, depth=BULK_QUEUE_DEPTH):
+        self.__slots = threading.Semaphore(concurrency)
+        self.__depth = depth
+        self.__lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.overflowed = 0
+        self.wait_time = 0.0
+
+    def run(self, function, *args):
+        with self.__lock:
+            if self.waiting >= self.__depth:
+                self.overflowed += 1
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+        start = time.perf_counter()
+        self.__slots.acquire()
+        with self.__lock:
+            self.waiting -= 1
+            self.running += 1
+            self.admitted += 1
+            self.wait_time += time.perf_counter() - start
+        try:
+            return function(*args)
+        finally:
+            with self.__lock:
+                self.running -= 1
+            self.__slots.release()
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'running': self.running,
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'admitted': self.admitted,
+                'overflowed': self.overflowed,
+                'wait_seconds': '{:.3f}'.format(self.wait_time),
+            }
+
+
+class SpamContent(object):
+    # The original contents: a whole spam message per path in one block,
+    # keyed by corpus index so every path hashing to it shares the buffer.
+    # A message does not change with the epoch, so the key leaves it out
+    # and the buffer, like its copy in a block cache, outlives restarts.
+    block_size = sys.maxsize
+
+    def key(self, path, epoch):
+        return ('spam', get_index(path))
+
+    def size(self, key, get_block):
+        return len(get_block(key, 0))
+
+    def render_block(self, key, block):
+        return render_spam(key[1]).encode('utf-8')
+
+
+class BlockContent(object):
+    # Large files whose blocks are each a function of (path, epoch,
+    # block), so reading at any offset only renders the blocks it covers
+    def __init__(self, sizes=None, block_size=BLOCK_SIZE):
+        self.sizes = sizes or SizeDistribution.fixed(LARGE_FILE_SIZE)
+        self.block_size = block_size
+
+    def key(self, path, epoch):
+        return ('blocks', path, epoch)
+
+    def size(self, key, get_block):
+        return self.sizes.size(key[1], key[2])
+
+    def render_block(self, key, block):
+        _, path, epoch = key
+        start = block * self.block_size
+        length = min(self.block_size, self.sizes.size(path, epoch) - start)
+        seed = (path.encode('utf-8') + epoch.to_bytes(8, byteorder='little') +
+                block.to_bytes(8, byteorder='little'))
+        rng = random.Random(hashlib.md5(seed).digest())
+        corpus = get_corpus()
+        runs = []
+        for _ in range(-(-length // CORPUS_RUN)):
+            run_start = rng.randrange(len(corpus) - CORPUS_RUN)
+            runs.append(corpus[run_start:run_start + CORPUS_RUN])
+        return b''.join(runs)[:length]
+
+
+class MarkovContent(object):
+    # Unbounded novel spam from a Markov chain. Generation is sequential,
+    # so the chain restarts at every segment and a checkpoint is kept at
+    # each block boundary reached; a block is rendered by resuming from
+    # the nearest earlier checkpoint in its segment.
+    def __init__(self, sizes=None, block_size=BLOCK_SIZE,
+                 order=MARKOV_ORDER):
+        self.sizes = sizes or SizeDistribution.fixed(LARGE_FILE_SIZE)
+        self.block_size = block_size
+        self.order = order
+        self.checkpoints = ShardedLRUCache(MARKOV_CHECKPOINTS,
+                                           sizeof=lambda _: 1)
+
+    def key(self, path, epoch):
+        return ('markov', path, epoch)
+
+    def size(self, key, get_block):
+        return self.sizes.size(key[1], key[2])
+
+    def render_block(self, key, block):
+        _, path, epoch = key
+        model = get_markov_model(self.order)
+        segment_start = block - block % MARKOV_SEGMENT_BLOCKS
+        start = block
+        checkpoint = None
+        while start > segment_start:
+            checkpoint = self.checkpoints.lookup((key, start))
+            if checkpoint is not None:
+                break
+            start -= 1
+        if checkpoint is None:
+            seed = (path.encode('utf-8') +
+                    epoch.to_bytes(8, byteorder='little') +
+                    segment_start.to_bytes(8, byteorder='little'))
+            rng = int.from_bytes(hashlib.md5(seed).digest()[:8],
+                                 byteorder='little')
+            checkpoint = (rng, 0, b'')
+        while True:
+            data, checkpoint = model.generate(*checkpoint, self.block_size)
+            start += 1
+            self.checkpoints.put((key, start), checkpoint)
+            if start > block:
+                break
+        return data[:self.sizes.size(path, epoch) - block * self.block_size]
+
+
+CONTENT_GENERATORS = {
+    'spam': SpamContent,
+    'blocks': BlockContent,
+    'markov': MarkovContent,
+}
+
+# Per render process: its generator and the shared memory slots it has
+# attached, by name
+_worker_generator = None
+_worker_slots = {}
+
+
+def _init_render_worker(generator_class, sizes, block_size):
+    global _worker_generator
+    _worker_generator = generator_class(sizes, block_size)
+
+
+def _render_into_slot(key, block, slot_name):
+    slot = _worker_slots.get(slot_name)
+    if slot is None:
+        # Workers share the parent's resource tracker, which already knows
+        # the segment, so attaching here does not add a second owner
+        slot = shared_memory.SharedMemory(slot_name)
+        _worker_slots[slot_name] = slot
+    data = _worker_generator.render_block(key, block)
+    slot.buf[:len(data)] = data
+    return len(data)
+
+
+class ProcessRenderer(object):
+    # Renders blocks in worker processes so generation runs outside this
+    # process's GIL. Blocks come back through preallocated shared memory
+    # slots instead of as pickled bytes. Each content key always goes to
+    # the same single-process pool, so per-process generator state such as
+    # Markov checkpoints stays useful.
+    def __init__(self, generator, processes):
+        context = multiprocessing.get_context('spawn')
+        self.__pools = [
+            concurrent.futures.ProcessPoolExecutor(
+                1, mp_context=context, initializer=_init_render_worker,
+                initargs=(type(generator), generator.sizes,
+                          generator.block_size))
+            for _ in range(processes)]
+        self.__slots = [
+            shared_memory.SharedMemory(create=True, size=generator.block_size)
+            for _ in range(processes * RENDER_SLOTS_PER_PROCESS)]
+        self.__free = queue.Queue()
+        for slot in self.__slots:
+            self.__free.put(slot)
+
+    def render_block(self, key, block):
+        pool = self.__pools[hash(key) % len(self.__pools)]
+        slot = self.__free.get()
+        try:
+            length = pool.submit(
+                _render_into_slot, key, block, slot.name).result()
+            return bytes(slot.buf[:length])
+        finally:
+            self.__free.put(slot)
+
+    def shutdown(self):
+        for pool in self.__pools:
+            pool.shutdown()
+        for slot in self.__slots:
+            slot.close()
+            slot.unlink()
+
+
+class PatternSearcher(object):
+    # Runs /.grep patterns over the corpus in a worker process. re holds
+    # the GIL for a whole search, so a pattern that backtracks for too
+    # long has to be killed rather than waited for. The pool is started
+    # on first use, after FUSE has daemonized.
+    def __init__(self, timeout=GREP_TIMEOUT):
+        self.timeout = timeout
+        self.timeouts = 0
+        self.__pool = None
+        self.__lock = threading.Lock()
+
+    def search(self, pattern, candidates):
+        with self.__lock:
+            if self.__pool is None:
+                self.__pool = multiprocessing.get_context('spawn').Pool(1)
+            pool = self.__pool
+        result = pool.apply_async(grep_spams, (pattern, candidates))
+        try:
+            return result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            with self.__lock:
+                self.timeouts += 1
+                if self.__pool is pool:
+                    self.__pool = None
+            pool.terminate()
+            raise FuseOSError(errno.ETIMEDOUT)
+
+    def shutdown(self):
+        with self.__lock:
+            pool, self.__pool = self.__pool, None
+        if pool is not None:
+            pool.terminate()
+
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+# Named workload presets. A profile file is JSON with the same keys, plus
+# an optional "base" naming a preset to start from.
+WORKLOAD_PROFILES = {
+    'flat': {
+        'entries': DIR_ENTRY_RANGE,
+        'depth': 0,
+        'fanout': TREE_FANOUT,
+        'content': 'spam',
+    },
+    'small-files': {
+        'entries': (50, 200),
+        'depth': 3,
+        'fanout': 4,
+        'content': 'blocks',
+        'sizes': [(90, 0, 4 * KB), (10, 4 * KB, 64 * KB)],
+    },
+    'source-tree': {
+        'entries': (5, 40),
+        'depth': 5,
+        'fanout': 3,
+        'content': 'markov',
+        'sizes': [(70, 100, 8 * KB), (25, 8 * KB, 64 * KB),
+                  (5, 64 * KB, MB)],
+    },
+    'mixed': {
+        'entries': (20, 100),
+        'depth': 4,
+        'fanout': 4,
+        'content': 'blocks',
+        'sizes': [(80, 0, 16 * KB), (15, 16 * KB, MB), (4.5, MB, 100 * MB),
+                  (0.5, 100 * MB, 4 * GB)],
+    },
+    'media': {
+        'entries': (10, 30),
+        'depth': 2,
+        'fanout': 3,
+        'content': 'blocks',
+        'sizes': [(20, 64 * KB, MB), (80, 10 * MB, 2 * GB)],
+    },
+}
+
+
+def load_profile(name):
+    # A preset name or the path of a JSON profile file
+    if name in WORKLOAD_PROFILES:
+        return dict(WORKLOAD_PROFILES[name])
+    with open(name) as profile_file:
+        overrides = json.load(profile_file)
+    profile = dict(WORKLOAD_PROFILES[overrides.pop('base', 'flat')])
+    profile.update(overrides)
+    return profile
+
+
+def make_generator(content, sizes=None):
+    if content == 'spam':
+        return SpamContent()
+    return CONTENT_GENERATORS[content](sizes and SizeDistribution(sizes))
+
+
 class WTFS(Operations):
     def __init__(self, *args, **kwargs):
-        self.__set_dir_contents()
+        self.slow_ops = SlowOpLog(
+            kwargs.get('slow_op_threshold', SLOW_OP_THRESHOLD))
+        self.hot_paths = HeavyHitters()
+        self.content = ShardedLRUCache(
+            kwargs.get('cache_size', CONTENT_CACHE_BYTES))
+        self.generator = kwargs.get('generator') or SpamContent()
+        self.entry_range = kwargs.get('entries', DIR_ENTRY_RANGE)
+        self.depth = kwargs.get('depth', TREE_DEPTH)
+        self.fanout = kwargs.get('fanout', TREE_FANOUT)
+        self.gzip = kwargs.get('gzip', False)
+        # Only directories that have been visited cost memory
+        self.listings = ShardedLRUCache(LISTING_CACHE_SIZE,
+                                        sizeof=lambda _: 1)
+        # Past epochs browsed through /.history get their own listing
+        # cache, so they never push the current epoch's out
+        self.history = LRUCache(HISTORY_EPOCHS, sizeof=lambda _: 1)
+        self.history_listings = ShardedLRUCache(HISTORY_LISTING_CACHE_SIZE,
+                                                sizeof=lambda _: 1)
+        block_cache = kwargs.get('block_cache')
+        self.block_cache = block_cache and BlockCacheFile(
+            block_cache, kwargs.get('block_cache_size', BLOCK_CACHE_BYTES))
+        render_processes = kwargs.get('render_processes', 0)
+        if render_processes:
+            self.renderer = ProcessRenderer(self.generator, render_processes)
+        else:
+            self.renderer = self.generator
+        self.bulk = BulkLane(
+            kwargs.get('bulk_concurrency', BULK_CONCURRENCY))
+        self.prefetch_blocks = kwargs.get('prefetch_blocks', PREFETCH_BLOCKS)
+        self.prefetcher = Prefetcher(self.content, self.__render_bulk)
+        self.virtual_files = {
+            '/.slowlog': self.slow_ops.dump,
+            '/.hot': self.hot_paths.dump,
+            '/.stats': self.__dump_stats,
+            '/.changes': self.__dump_changes,
+        }
+        # Names added and removed in the root by each regeneration, as
+        # the lines /.changes reports
+        self.changes = collections.deque(maxlen=CHANGES_EPOCHS)
+        # Only spam content maps each file to one corpus entry, so only it
+        # can be searched through the index
+        self.search_index = None
+        self.search_dirs = {}
+        self.pattern_searcher = PatternSearcher()
+        if isinstance(self.generator, SpamContent):
+            self.search_index = get_search_index()
+            get_trigram_index()
+            self.search_dirs = {
+                SEARCH_DIR: self.__find_term,
+                FGREP_DIR: find_substring,
+                GREP_DIR: lambda pattern: find_pattern(
+                    pattern, self.pattern_searcher.search),
+            }
+        self.epoch = None
+        # Line offsets of manifests by directory, and CRC32s by content
+        # key, so paths sharing content are checksummed once
+        self.manifests = LRUCache(MANIFEST_CACHE_SIZE, sizeof=lambda _: 1)
+        self.checksums = LRUCache(CHECKSUM_CACHE_SIZE, sizeof=lambda _: 1)
+        self.__buffers = {}
+        self.__manifests = {}
+        self.__handles = {}
+        self.__next_fh = 1
+        self.__fh_lock = threading.Lock()
+        self.__epoch_lock = threading.Lock()
+        # Hybrid mode: each epoch is materialized below this directory,
+        # ideally a tmpfs, and opens of a ready epoch go to the real files
+        self.tmpfs = kwargs.get('tmpfs')
+        self.tmpfs_epoch = None
+        self.tmpfs_opens = 0
+        self.tmpfs_skipped = 0
+        self.__tmpfs_lock = threading.Lock()
+        # FUSE forks to daemonize after __init__, and threads started
+        # before that do not survive it, so none start until init()
+        self.__mounted = False
+        # Warm start: listings saved by destroy() are reloaded by init(),
+        # so the first epoch is not built here if there are any
+        self.state = kwargs.get('state')
+        self.__saved_listings = {}
+        self.__warm_start = bool(self.state) and os.path.exists(self.state)
+        if self.__warm_start:
+            self.epoch = self.last_readdir_time = int(time.time())
+        else:
+            self.__set_dir_contents()
+
+    def __call__(self, op, *args):
+        start = time.perf_counter()
+        try:
+            return super().__call__(op, *args)
+        finally:
+            duration = time.perf_counter() - start
+            if duration >= self.slow_ops.threshold:
+                self.slow_ops.record(op, args, self.epoch, duration)
+
+    def __dump_stats(self):
+        stats = [('cache', self.content.stats()),
+                 ('block_cache', self.block_cache.stats()
+                  if self.block_cache else {}),
+                 ('listings', self.listings.stats()),
+                 ('history', self.history_listings.stats()),
+                 ('prefetch', self.prefetcher.stats()),
+                 ('bulk', self.bulk.stats()),
+                 ('grep', {'timeouts': self.pattern_searcher.timeouts}),
+                 ('tmpfs', {'epoch': self.tmpfs_epoch,
+                            'opens': self.tmpfs_opens,
+                            'skipped': self.tmpfs_skipped}),
+                 ('dedup', self.__dedup_stats(self.epoch))]
+        return ''.join(
+            '{}.{} {}\n'.format(group, name, value)
+            for group, values in stats
+            for name, value in values.items()
+        ).encode('utf-8')
+
+    def __dump_changes(self):
+        return b''.join(self.changes)
+
+    def __dedup_stats(self, epoch):
+        # Bytes the cached listings would hold with a buffer per path
+        # versus one buffer per corpus entry
+        paths = 0
+        logical = 0
+        stored = {}
+        for listing in self.listings.values():
+            if listing.epoch != epoch:
+                continue
+            for name, attrs in listing.attrs.items():
+                paths += 1
+                if not self.__is_gzip(name) and \
+                        stat.S_ISREG(attrs['st_mode']):
+                    logical += attrs['st_size']
+                    key = self.generator.key(join_path(listing.path, name),
+                                             epoch)
+                    stored[key] = attrs['st_size']
+        stored = sum(stored.values())
+        return {
+            'paths': paths,
+            'logical_bytes': logical,
+            'stored_bytes': stored,
+            'ratio': '{:.2f}'.format(logical / stored if stored else 1.0),
+        }
+
+    def __load_block(self, key, block, render):
+        # Below the in-memory cache: the on-disk block cache, if any, and
+        # only then actually rendering
+        if self.block_cache is None:
+            return render(key, block)
+        data = self.block_cache.lookup((key, block))
+        if data is None:
+            data = render(key, block)
+            self.block_cache.put((key, block), data)
+        return data
+
+    def __get_block(self, key, block):
+        return self.content.get(
+            (key, block),
+            lambda: self.__load_block(key, block, self.renderer.render_block))
+
+    def __render_bulk(self, key, block):
+        return self.__load_block(
+            key, block,
+            functools.partial(self.bulk.run, self.renderer.render_block))
+
+    def __read_block(self, key, block):
+        # Cache hits are served directly; only rendering is queued
+        return self.content.get(
+            (key, block), lambda: self.__render_bulk(key, block))
+
+    def __is_gzip(self, path):
+        # Words never contain a dot, so only twins end in .gz
+        return self.gzip and path.endswith('.gz')
+
+    def __get_gzip(self, key, cached=True):
+        # Compressed once per content key and then sliced by every read.
+        # mtime is fixed so the output, and so st_size, is deterministic.
+        # Rendering and compressing go through the bulk lane, and content
+        # too large for a twin is never compressed. Uncached, nothing
+        # rendered or compressed here is kept.
+        get_block = self.__get_block if cached else self.__peek_block
+        size = self.generator.size(key, get_block)
+        if size > GZIP_MAX_SIZE:
+            raise FuseOSError(errno.ENOENT)
+
+        def compress():
+            data = b''.join(
+                get_block(key, block)
+                for block in range(-(-size // self.generator.block_size)))
+            return gzip.compress(data, mtime=0)
+        if not cached:
+            data = self.content.lookup(('gzip', key))
+            return self.bulk.run(compress) if data is None else data
+        return self.content.get(('gzip', key),
+                                lambda: self.bulk.run(compress))
+
+    def __gzip_attrs(self, path, epoch, cached=True):
+        attrs = dict(self.__file_attrs(path, epoch))
+        attrs['st_size'] = len(
+            self.__get_gzip(self.generator.key(path[:-3], epoch), cached))
+        return attrs
+
+    def __entry_attrs(self, listing, name, cached=True):
+        # Twins are listed with None, and their size is only worked out
+        # when one is asked for
+        attrs = listing.attrs[name]
+        if attrs is None:
+            return self.__gzip_attrs(join_path(listing.path, name),
+                                     listing.epoch, cached)
+        return attrs
+
+    def __dir_attrs(self, epoch, nlink):
+        return {
+            'st_atime': epoch,
+            'st_ctime': epoch,
+            'st_mtime': epoch,
+            'st_mode': stat.S_IFDIR | 0o555,
+            'st_nlink': nlink,
+        }
+
+    def __file_attrs(self, path, epoch):
+        return {
+            'st_atime': epoch,
+            'st_ctime': epoch,
+            'st_mtime': epoch,
+            'st_mode': stat.S_IFREG | 0o444,
+            'st_nlink': 1,
+            'st_ino': get_index(path),
+            'st_size': self.generator.size(
+                self.generator.key(path, epoch), self.__get_block),
+        }
+
+    def __get_listing(self, path, epoch, listings=None):
+        # None when path is not a directory in this epoch. Resolving a
+        # path walks down from the root, but each level is a cache hit
+        # once visited.
+        if listings is None:
+            listings = self.listings
+        if path != '/':
+            parent, name = split_path(path)
+            parent_listing = self.__get_listing(parent, epoch, listings)
+            if parent_listing is None or name not in parent_listing.subdirs:
+                return None
+        return listings.get(
+            (path, epoch), lambda: self.__restore_listing(path, epoch) or
+            self.__build_listing(path, epoch))
+
+    def __restore_listing(self, path, epoch):
+        # Each saved listing is marshalled on its own, and only decoded
+        # when first asked for
+        saved = self.__saved_listings.pop((path, epoch), None)
+        return saved and Listing(*marshal.loads(saved))
+
+    def __build_listing(self, path, epoch):
+        names = get_dir_entries(path, epoch, self.entry_range)
+        depth = 0 if path == '/' else path.count('/')
+        subdirs = frozenset(names[:self.fanout] if depth < self.depth else ())
+        # Every stat dict for the directory is built up front so getattr
+        # is a single lookup, except for gzip twins, whose size takes
+        # compressing the file. fusepy only reads the dicts, so they are
+        # shared. Subdirectories report one link, which tells find not to
+        # infer their subdirectory count from st_nlink.
+        attrs = {}
+        for name in names:
+            if name in subdirs:
+                attrs[name] = self.__dir_attrs(epoch, 1)
+                continue
+            child = join_path(path, name)
+            attrs[name] = self.__file_attrs(child, epoch)
+            if self.gzip and attrs[name]['st_size'] <= GZIP_MAX_SIZE:
+                attrs[name + '.gz'] = None
+        dir_contents = ['.', '..'] + list(attrs)
+        return Listing(path, epoch, dir_contents, subdirs,
+                       self.__dir_attrs(epoch, len(dir_contents)), attrs)
+
+    def __history_path(self, path):
+        # (path, epoch) in the tree of the epoch a path below
+        # /.history/<epoch> points into, or None for any other path
+        if not path.startswith(HISTORY_DIR + '/'):
+            return None
+        parts = path.split('/', 3)
+        if not parts[2].isdigit() or int(parts[2]) > self.epoch:
+            raise FuseOSError(errno.ENOENT)
+        return '/' + (parts[3] if len(parts) > 3 else ''), int(parts[2])
+
+    def __history_listing(self, path, epoch):
+        # Any past epoch can be browsed since listings are a function of
+        # the epoch, and the most recently browsed ones are listed
+        if self.history.lookup(epoch) is None:
+            self.history.put(epoch, True)
+        if epoch == self.epoch:
+            return self.__get_listing(path, epoch)
+        return self.__get_listing(path, epoch, self.history_listings)
+
+    def __history_contents(self):
+        return ['.', '..'] + [str(epoch)
+                              for epoch, _ in sorted(self.history.items())]
+
+    def __history_attrs(self, path, epoch):
+        if path == '/':
+            return self.__history_listing(path, epoch).dir_attrs
+        parent, name = split_path(path)
+        listing = self.__history_listing(parent, epoch)
+        if listing is None or name not in listing.attrs:
+            raise FuseOSError(errno.ENOENT)
+        return self.__entry_attrs(listing, name)
+
+    def __search_path(self, path):
+        # (search directory, query, path of the match) for paths at or
+        # below a search directory, with None for the parts not given,
+        # or None for any other path. Matches are named by their path
+        # with dots for slashes, which words never contain.
+        if not path.startswith('/.'):
+            return None
+        parts = path.split('/', 3)
+        search_dir = '/' + parts[1]
+        if search_dir not in (SEARCH_DIR, FGREP_DIR, GREP_DIR):
+            return None
+        if search_dir not in self.search_dirs:
+            raise FuseOSError(errno.ENOENT)
+        query = parts[2] if len(parts) > 2 else None
+        match = '/' + parts[3].replace('.', '/') if len(parts) > 3 else None
+        return search_dir, query, match
+
+    def __find_term(self, term):
+        return self.search_index.get(term.lower(), frozenset())
+
+    def __search_results(self, search_dir, query):
+        # Corpus indexes the query matches
+        try:
+            return self.search_dirs[search_dir](query)
+        except re.error:
+            raise FuseOSError(errno.EINVAL)
+
+    def __search_matches(self, search_dir, query, epoch):
+        # The files of the epoch's visited directories the query matches,
+        # found by probing the results with each file's corpus index
+        results = self.__search_results(search_dir, query)
+        matches = []
+        for (path, listing_epoch), listing in self.listings.items():
+            if listing_epoch != epoch:
+                continue
+            for name in listing.attrs:
+                if name in listing.subdirs or '.' in name:
+                    continue
+                child = join_path(path, name)
+                if get_index(child) in results:
+                    matches.append(child[1:].replace('/', '.'))
+        return sorted(matches)
+
+    def __search_attrs(self, path, epoch):
+        search_dir, query, match = self.__search_path(path)
+        if match is None:
+            return self.__dir_attrs(epoch, 2)
+        parent, name = split_path(match)
+        listing = self.__get_listing(parent, epoch)
+        if (listing is None or name not in listing.attrs or
+                name in listing.subdirs or get_index(match) not in
+                self.__search_results(search_dir, query)):
+            raise FuseOSError(errno.ENOENT)
+        return {
+            'st_atime': epoch,
+            'st_ctime': epoch,
+            'st_mtime': epoch,
+            'st_mode': stat.S_IFLNK | 0o777,
+            'st_nlink': 1,
+            'st_size': len(self.readlink(path)),
+        }
+
+    def __manifest_line(self, listing, name, checksum, sized=True):
+        # "<crc32> <size> <inode> <name>". The CRC is always 8 wide, and
+        # so is a gzip twin's size, zero padded, since it takes
+        # compressing the file. Line lengths are then known from the stat
+        # table alone, with sized False leaving twins uncompressed.
+        if name in listing.subdirs:
+            return '-------- - - {}\n'.format(name).encode('utf-8')
+        attrs = listing.attrs[name]
+        if attrs is None:
+            size = '{:08d}'.format(
+                self.__entry_attrs(listing, name)['st_size'] if sized else 0)
+            inode = get_index(join_path(listing.path, name))
+        else:
+            size, inode = attrs['st_size'], attrs['st_ino']
+        return '{} {} {} {}\n'.format(
+            checksum, size, inode, name).encode('utf-8')
+
+    def __find_manifest(self, path):
+        # The manifest a .manifest path names, in the live tree or below
+        # /.history/<epoch>
+        history = self.__history_path(path)
+        path, epoch = history or (path, self.epoch)
+        manifest = self.__get_manifest(split_path(path)[0], epoch,
+                                       history is not None)
+        if manifest is None:
+            raise FuseOSError(errno.ENOENT)
+        return manifest
+
+    def __get_manifest(self, path, epoch, history=False):
+        # None when path is not a directory in this epoch
+        def build():
+            if history:
+                listing = self.__history_listing(path, epoch)
+            else:
+                listing = self.__get_listing(path, epoch)
+            if listing is None:
+                return None
+            offsets = array.array('Q', [0])
+            for name in listing.attrs:
+                offsets.append(offsets[-1] + len(
+                    self.__manifest_line(listing, name, '0' * 8, False)))
+            return Manifest(listing, offsets)
+        return self.manifests.get((path, epoch), build)
+
+    def __checksum(self, path, epoch):
+        # None for files over CHECKSUM_MAX_SIZE, which would take
+        # rendering too much. gzip twins are never that large.
+        if self.__is_gzip(path):
+            key = self.generator.key(path[:-3], epoch)
+            return self.checksums.get(
+                ('gzip', key), lambda: zlib.crc32(self.__get_gzip(key)))
+        key = self.generator.key(path, epoch)
+        size = self.generator.size(key, self.__get_block)
+        if size > CHECKSUM_MAX_SIZE:
+            return None
+        return self.checksums.get(
+            key, lambda: self.bulk.run(self.__crc_blocks, key, size))
+
+    def __peek_block(self, key, block):
+        # A cached block if there is one, otherwise a fresh render that is
+        # not kept in either cache, so bulk work never pushes out what
+        # readers need
+        data = self.content.lookup((key, block))
+        if data is None:
+            data = self.renderer.render_block(key, block)
+        return data
+
+    def __crc_blocks(self, key, size):
+        block_size = self.generator.block_size
+        crc = 0
+        for block in range(-(-size // block_size)):
+            crc = zlib.crc32(self.__peek_block(key, block)[
+                :size - block * block_size], crc)
+        return crc
+
+    def __read_manifest(self, manifest, offset, length):
+        # Only the lines overlapping the read are rendered, so a client
+        # paging through a huge directory checksums it bit by bit
+        listing, offsets = manifest
+        names = list(listing.attrs)
+        end = min(offset + length, offsets[-1])
+        first = max(bisect.bisect_right(offsets, offset) - 1, 0)
+        lines = []
+        for i in range(first, len(names)):
+            if offsets[i] >= end:
+                break
+            name = names[i]
+            checksum = None
+            if name not in listing.subdirs:
+                crc = self.__checksum(join_path(listing.path, name),
+                                      listing.epoch)
+                checksum = '--------' if crc is None else '{:08x}'.format(crc)
+            lines.append(self.__manifest_line(listing, name, checksum))
+        data = b''.join(lines)
+        start = offset - offsets[first]
+        return data[start:start + end - offset]
 
     def __set_dir_contents(self):
-        now = int(time.time())
-        self.last_readdir_time = now
-        self.dir_contents = (
-            ['.', '..'] +
-            [get_word((now + i).to_bytes(8, byteorder='little'))
-             for i in range(random.randint(*DIR_ENTRY_RANGE))]
-        )
+        previous = self.epoch
+        self.__publish_epoch(int(time.time()))
+        if previous is not None and previous != self.epoch:
+            self.__record_changes(previous, self.epoch)
+
+    def __record_changes(self, previous, epoch):
+        # Worked out once per regeneration, from the two root listings
+        added, removed = diff_sorted(
+            sorted(self.__get_listing('/', previous).dir_contents[2:]),
+            sorted(self.__get_listing('/', epoch).dir_contents[2:]))
+        self.changes.append(''.join(
+            ['{} {} +{}\n'.format(epoch, previous, name) for name in added] +
+            ['{} {} -{}\n'.format(epoch, previous, name)
+             for name in removed]).encode('utf-8'))
+
+    def __publish_epoch(self, epoch):
+        # The root listing is built before the epoch is published so the
+        # first readdir of it is a cache hit
+        self.__get_listing('/', epoch)
+        self.history.put(epoch, True)
+        self.epoch = epoch
+        self.last_readdir_time = int(time.time())
+        if self.__mounted:
+            self.__start_tmpfs(epoch)
+
+    def __start_tmpfs(self, epoch):
+        if self.tmpfs and self.__tmpfs_lock.acquire(blocking=False):
+            threading.Thread(target=self.__fill_tmpfs, args=(epoch,),
+                             name='tmpfs', daemon=True).start()
+
+    def save_state(self):
+        # The current epoch, every listing of it with its stat table and
+        # the keys in the content cache, as compressed marshal data.
+        # Written aside and renamed so a crash never leaves half a file.
+        # Saved listings never asked for since the last load are kept
+        listings = dict(self.__saved_listings)
+        listings.update((key, marshal.dumps(tuple(listing)))
+                        for key, listing in self.listings.items())
+        listings = {key: listing for key, listing in listings.items()
+                    if key[1] == self.epoch}
+        state = {
+            'tree': self.__tree_fingerprint(),
+            'epoch': self.epoch,
+            'listings': list(listings.items()),
+            'content_keys': [key for key, _ in self.content.items()],
+        }
+        partial = self.state + '.partial'
+        with open(partial, 'wb') as state_file:
+            state_file.write(STATE_MAGIC +
+                             zlib.compress(marshal.dumps(state)))
+        os.replace(partial, self.state)
+
+    def __tree_fingerprint(self):
+        # Everything listings and their stat tables are a function of,
+        # besides path and epoch
+        generator = self.generator
+        sizes = getattr(generator, 'sizes', None)
+        return repr((self.entry_range, self.depth, self.fanout, self.gzip,
+                     type(generator).__name__, generator.block_size,
+                     sizes and sizes.buckets))
+
+    def load_state(self):
+        # Returns False if there is no usable state. A restart keeps the
+        # saved epoch, so clients see the same tree across it.
+        try:
+            with open(self.state, 'rb') as state_file:
+                data = state_file.read()
+            if not data.startswith(STATE_MAGIC):
+                return False
+            state = marshal.loads(zlib.decompress(data[len(STATE_MAGIC):]))
+        except (OSError, ValueError, EOFError, TypeError, zlib.error):
+            return False
+        # Listings saved for a differently shaped tree would be wrong
+        if state.get('tree') != self.__tree_fingerprint():
+            return False
+        self.__saved_listings = dict(state['listings'])
+        self.__publish_epoch(state['epoch'])
+        if self.block_cache is not None:
+            threading.Thread(target=self.__warm_content,
+                             args=(state['content_keys'],),
+                             name='warm', daemon=True).start()
+        return True
+
+    def __warm_content(self, keys):
+        # Refill the in-memory cache with what it held before the restart,
+        # from the on-disk block cache
+        for key in keys:
+            if key not in self.content:
+                data = self.block_cache.lookup(key)
+                if data is not None:
+                    self.content.put(key, data)
+
+    def init(self, path):
+        # Called once the daemon is running
+        self.__mounted = True
+        if self.__warm_start and self.load_state():
+            return
+        if self.__warm_start:
+            # The placeholder epoch was never published, so there is
+            # nothing for the first real one to be diffed against
+            self.epoch = None
+            self.__set_dir_contents()
+        else:
+            self.__start_tmpfs(self.epoch)
+
+    def __fits_tmpfs(self, epoch, path='/', totals=None):
+        # Whether an epoch is within the tmpfs budget, giving up as soon
+        # as it is not. Twins are counted at their source's size, which
+        # is what their copy can grow to.
+        if totals is None:
+            totals = [0, 0]
+        listing = self.__get_listing(path, epoch)
+        for name, attrs in listing.attrs.items():
+            if name in listing.subdirs:
+                if not self.__fits_tmpfs(epoch, join_path(path, name),
+                                         totals):
+                    return False
+                continue
+            if attrs is None:
+                attrs = listing.attrs[name[:-3]]
+            totals[0] += 1
+            totals[1] += attrs['st_size']
+            if totals[0] > TMPFS_MAX_FILES or totals[1] > TMPFS_MAX_BYTES:
+                return False
+        return True
+
+    def __fill_tmpfs(self, epoch):
+        # Runs with __tmpfs_lock held, so an epoch that rotates out while
+        # it is still being written is skipped rather than piling up
+        # writers, and so is one over the budget. Blocks are rendered in
+        # the bulk lane and not cached, so a copy neither starves nor
+        # flushes foreground reads. Earlier epochs' copies are deleted once
+        # the new one is ready; open handles keep their unlinked files.
+        try:
+            if not self.__fits_tmpfs(epoch):
+                self.tmpfs_skipped += 1
+                return
+            materialize(self, epoch, os.path.join(self.tmpfs, str(epoch)),
+                        TMPFS_WORKERS, out=None, cached=False)
+            self.tmpfs_epoch = epoch
+            for name in os.listdir(self.tmpfs):
+                if name.isdigit() and int(name) < epoch:
+                    shutil.rmtree(os.path.join(self.tmpfs, name),
+                                  ignore_errors=True)
+        finally:
+            self.__tmpfs_lock.release()
 
     def readdir(self, path, offset):
-        for dir_entry in self.dir_contents:
-            now = int(time.time())
-            if self.last_readdir_time < now - REGEN_CONTENTS_TIMEOUT:
-                self.__set_dir_contents()
-            self.last_readdir_time = now
-            yield dir_entry
+        # Return a list rather than yielding so fusepy's iteration happens
+        # inside __call__ and the whole upcall is timed
+        self.hot_paths.add(path)
+        now = int(time.time())
+        if self.last_readdir_time < now - REGEN_CONTENTS_TIMEOUT:
+            # Checked again under the lock so concurrent readdirs build
+            # the new epoch once
+            with self.__epoch_lock:
+                if self.last_readdir_time < now - REGEN_CONTENTS_TIMEOUT:
+                    self.__set_dir_contents()
+        self.last_readdir_time = now
+        if path == HISTORY_DIR:
+            return self.__history_contents()
+        search = self.__search_path(path)
+        if search is not None:
+            search_dir, query, match = search
+            if match is not None:
+                raise FuseOSError(errno.ENOTDIR)
+            if query is None:
+                return ['.', '..']
+            return ['.', '..'] + self.__search_matches(
+                search_dir, query, self.epoch)
+        history = self.__history_path(path)
+        if history is not None:
+            listing = self.__history_listing(*history)
+        else:
+            listing = self.__get_listing(path, self.epoch)
+        if listing is None:
+            raise FuseOSError(errno.ENOENT)
+        return list(listing.dir_contents)
 
     def getattr(self, path, fh=None):
-        attrs = {
-            'st_atime': self.last_readdir_time,
-            'st_ctime': self.last_readdir_time,
-            'st_mtime': self.last_readdir_time,
-        }
+        self.hot_paths.add(path)
+        epoch = self.epoch
         if path == '/':
-            attrs.update({
-                'st_mode': stat.S_IFDIR | 0o555,
-                'st_nlink': len(self.dir_contents),
-            })
-        else:
-            attrs.update({
+            return self.__get_listing(path, epoch).dir_attrs
+        if path in self.virtual_files:
+            return {
+                'st_atime': epoch,
+                'st_ctime': epoch,
+                'st_mtime': epoch,
+                'st_mode': stat.S_IFREG | 0o444,
+                'st_nlink': 1,
+                'st_size': len(self.virtual_files[path]()),
+            }
+        if path == HISTORY_DIR:
+            return self.__dir_attrs(epoch, len(self.__history_contents()))
+        if self.__search_path(path) is not None:
+            return self.__search_attrs(path, epoch)
+        parent, name = split_path(path)
+        if name == MANIFEST_NAME:
+            manifest = self.__find_manifest(path)
+            return {
+                'st_atime': manifest.listing.epoch,
+                'st_ctime': manifest.listing.epoch,
+                'st_mtime': manifest.listing.epoch,
                 'st_mode': stat.S_IFREG | 0o444,
                 'st_nlink': 1,
-                'st_ino': get_index(path),
-                'st_size': len(get_spam(path)),
-            })
+                'st_size': manifest.offsets[-1],
+            }
+        history = self.__history_path(path)
+        if history is not None:
+            return self.__history_attrs(*history)
+        listing = self.__get_listing(parent, epoch)
+        if listing is not None and name in listing.attrs:
+            return self.__entry_attrs(listing, name)
+        # Names from earlier epochs stay readable, but twins only exist
+        # where a listing has them
+        if self.__is_gzip(path):
+            raise FuseOSError(errno.ENOENT)
+        return self.__file_attrs(path, epoch)
+
+    def readlink(self, path):
+        # Search matches point back into the tree, relative to the
+        # directory of their query
+        search = self.__search_path(path)
+        if search is None:
+            raise FuseOSError(errno.ENOENT)
+        match = search[2]
+        if match is None:
+            raise FuseOSError(errno.EINVAL)
+        return '../..' + match
+
+    def __xattrs(self, path):
+        # Extended attributes by name, as functions so listing them
+        # computes nothing. Only the root and entries of an epoch's
+        # listings have any, paths below /.history/<epoch> included.
+        history = self.__history_path(path)
+        path, epoch = history or (path, self.epoch)
+        attrs = {XATTR_PREFIX + 'epoch': lambda: str(epoch)}
+        if path == '/':
+            return attrs
+        parent, name = split_path(path)
+        listings = None
+        if history is not None and epoch != self.epoch:
+            listings = self.history_listings
+        listing = self.__get_listing(parent, epoch, listings)
+        if listing is None or name not in listing.attrs:
+            return {}
+        if name in listing.subdirs:
+            return attrs
+        source = path[:-3] if self.__is_gzip(path) else path
+        if isinstance(self.generator, SpamContent):
+            attrs[XATTR_PREFIX + 'index'] = lambda: str(get_index(source))
+        else:
+            # What the file's size and blocks are derived from
+            attrs[XATTR_PREFIX + 'seed'] = lambda: hashlib.md5(
+                source.encode('utf-8') +
+                epoch.to_bytes(8, byteorder='little')).hexdigest()
+        # A checksum takes rendering the whole file, so large files go
+        # without one
+        source_attrs = listing.attrs[split_path(source)[1]]
+        if source_attrs['st_size'] > CHECKSUM_MAX_SIZE:
+            return attrs
+        attrs[XATTR_PREFIX + 'crc32'] = lambda: '{:08x}'.format(
+            self.__checksum(path, epoch))
         return attrs
 
+    def getxattr(self, path, name, position=0):
+        value = self.__xattrs(path).get(name)
+        if value is None:
+            raise FuseOSError(errno.ENODATA)
+        return value().encode('utf-8')
+
+    def listxattr(self, path):
+        return list(self.__xattrs(path))
+
+    def walk(self, epoch, path='/', cached=True):
+        # Depth-first (path, attrs) for everything below path in an epoch.
+        # Uncached, twins are sized without keeping what they compress to.
+        listing = self.__get_listing(path, epoch)
+        for name in listing.attrs:
+            child = join_path(path, name)
+            yield child, self.__entry_attrs(listing, name, cached)
+            if name in listing.subdirs:
+                yield from self.walk(epoch, child, cached)
+
+    def iter_content(self, path, epoch, cached=True):
+        # A file's contents in an epoch, one block at a time. Uncached,
+        # blocks are rendered in the bulk lane and not kept.
+        if self.__is_gzip(path):
+            yield self.__get_gzip(self.generator.key(path[:-3], epoch),
+                                  cached)
+            return
+        key = self.generator.key(path, epoch)
+        if cached:
+            get_block = self.__get_block
+        else:
+            get_block = functools.partial(self.bulk.run, self.__peek_block)
+        size = self.generator.size(key, get_block)
+        for block in range(-(-size // self.generator.block_size)):
+            yield get_block(key, block)[
+                :size - block * self.generator.block_size]
+
     def open(self, path, flags):
-        return 0
+        with self.__fh_lock:
+            fh = self.__next_fh
+            self.__next_fh += 1
+        if path in self.virtual_files:
+            # Render virtual files once per open so every read of the
+            # handle sees the same contents
+            self.__buffers[fh] = self.virtual_files[path]()
+        elif split_path(path)[1] == MANIFEST_NAME:
+            self.__manifests[fh] = self.__find_manifest(path)
+        else:
+            path, epoch = self.__history_path(path) or (path, self.epoch)
+            fd = None
+            if self.tmpfs_epoch == epoch:
+                try:
+                    fd = os.open(os.path.join(self.tmpfs, str(epoch),
+                                              path.lstrip('/')),
+                                 os.O_RDONLY)
+                    with self.__fh_lock:
+                        self.tmpfs_opens += 1
+                except FileNotFoundError:
+                    # Names from earlier epochs are still rendered
+                    pass
+            if self.__is_gzip(path):
+                path = path[:-3]
+            self.__handles[fh] = Handle(self.generator.key(path, epoch), fd)
+        return fh
 
     def read(self, path, length, offset, fh=None):
-        return get_spam(path)[offset:offset+length].encode('utf-8')
+        if fh in self.__buffers:
+            return self.__buffers[fh][offset:offset+length]
+        if fh in self.__manifests:
+            return self.__read_manifest(self.__manifests[fh], offset, length)
+        generator = self.generator
+        block_size = generator.block_size
+        handle = self.__handles.get(fh)
+        if handle is not None and handle.fd is not None:
+            data = os.pread(handle.fd, length, offset)
+            self.hot_paths.add(path, len(data))
+            return data
+        content_path, epoch = self.__history_path(path) or (path, self.epoch)
+        is_gzip = self.__is_gzip(content_path)
+        if handle is not None:
+            key = handle.key
+        else:
+            key = generator.key(
+                content_path[:-3] if is_gzip else content_path, epoch)
+        if is_gzip:
+            data = self.__get_gzip(key)[offset:offset+length]
+            self.hot_paths.add(path, len(data))
+            return data
+        size = generator.size(key, self.__get_block)
+        end = min(offset + length, size)
+        # Only the blocks covering [offset, end) are rendered
+        chunks = []
+        for block in range(offset // block_size, -(-end // block_size)):
+            self.prefetcher.wait(key, block)
+            block_start = block * block_size
+            chunks.append(self.__read_block(key, block)[
+                max(offset - block_start, 0):end - block_start])
+        data = b''.join(chunks)
+        self.hot_paths.add(path, len(data))
+        if handle is not None:
+            if offset == handle.next_offset:
+                handle.sequential += 1
+            else:
+                handle.sequential = 0
+            handle.next_offset = end
+            if handle.sequential >= SEQUENTIAL_READS:
+                first = -(-end // block_size)
+                last = min(first + self.prefetch_blocks,
+                           -(-size // block_size))
+                self.prefetcher.prefetch(key, range(first, last))
+        return data
+
+    def release(self, path, fh):
+        self.__buffers.pop(fh, None)
+        self.__manifests.pop(fh, None)
+        handle = self.__handles.pop(fh, None)
+        if handle is not None and handle.fd is not None:
+            os.close(handle.fd)
+        return 0
 
+    def destroy(self, path):
+        if self.state:
+            self.save_state()
+        self.prefetcher.shutdown()
+        self.pattern_searcher.shutdown()
+        if self.renderer is not self.generator:
+            self.renderer.shutdown()
+        if self.block_cache is not None:
+            self.block_cache.close()
+        if self.tmpfs and os.path.isdir(self.tmpfs):
+            # Give a copy in progress a while to finish before removing
+            # them all, but never hang the unmount on it. DIR is only made
+            # by the first copy, and every epoch may have been skipped.
+            locked = self.__tmpfs_lock.acquire(timeout=TMPFS_DESTROY_TIMEOUT)
+            try:
+                for name in os.listdir(self.tmpfs):
+                    if name.isdigit():
+                        shutil.rmtree(os.path.join(self.tmpfs, name),
+                                      ignore_errors=True)
+            finally:
+                if locked:
+                    self.__tmpfs_lock.release()
+
+
+class ChunkReader(object):
+    # File-like read() over an iterator of byte chunks, so tarfile can
+    # stream a file without it ever being held whole
+    def __init__(self, chunks):
+        self.__chunks = chunks
+        self.__buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.__buffer) < size:
+            chunk = next(self.__chunks, None)
+            if chunk is None:
+                break
+            self.__buffer += chunk
+        if size < 0:
+            size = len(self.__buffer)
+        data = self.__buffer[:size]
+        self.__buffer = self.__buffer[size:]
+        return data
+
+
+def export_tar(wtfs, epochs, out):
+    # Headers and contents are produced entry by entry as the archive is
+    # written, so memory stays constant however large the tree is. With
+    # several epochs each one gets its own top-level directory.
+    with tarfile.open(fileobj=out, mode='w|',
+                      bufsize=TAR_BUFFER_SIZE) as tar:
+        for epoch in epochs:
+            prefix = str(epoch) if len(epochs) > 1 else ''
+            if prefix:
+                info = tarfile.TarInfo(prefix)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o555
+                info.mtime = epoch
+                tar.addfile(info)
+            for path, attrs in wtfs.walk(epoch):
+                info = tarfile.TarInfo((prefix + path).lstrip('/'))
+                info.mode = stat.S_IMODE(attrs['st_mode'])
+                info.mtime = attrs['st_mtime']
+                if stat.S_ISDIR(attrs['st_mode']):
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                else:
+                    info.size = attrs['st_size']
+                    tar.addfile(info, ChunkReader(
+                        wtfs.iter_content(path, epoch)))
+
+
+# Per materialize writer thread: its preallocated write buffer. Per
+# materialize writer process: its own WTFS built from the command line.
+_writer_state = threading.local()
+_writer_wtfs = None
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def write_file(wtfs, path, attrs, epoch, dest, cached=True):
+    # Returns the bytes written, or None if a complete copy from an
+    # earlier run is already there. Files are written under a temporary
+    # name and renamed into place, so a file with the expected size and
+    # mtime is always complete.
+    try:
+        existing = os.stat(dest)
+        if existing.st_size == attrs['st_size'] and \
+                existing.st_mtime == attrs['st_mtime']:
+            return None
+    except FileNotFoundError:
+        pass
+    buffer = getattr(_writer_state, 'buffer', None)
+    if buffer is None:
+        buffer = _writer_state.buffer = bytearray(WRITE_BUFFER_SIZE)
+    view = memoryview(buffer)
+    partial = dest + '.partial'
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if attrs['st_size'] > WRITE_BUFFER_SIZE:
+            os.posix_fallocate(fd, 0, attrs['st_size'])
+        filled = 0
+        for chunk in wtfs.iter_content(path, epoch, cached):
+            chunk = memoryview(chunk)
+            if not filled and len(chunk) >= len(buffer):
+                write_all(fd, chunk)
+                continue
+            while chunk:
+                count = min(len(chunk), len(buffer) - filled)
+                view[filled:filled + count] = chunk[:count]
+                filled += count
+                chunk = chunk[count:]
+                if filled == len(buffer):
+                    write_all(fd, view)
+                    filled = 0
+        write_all(fd, view[:filled])
+    finally:
+        os.close(fd)
+    os.utime(partial, (attrs['st_mtime'], attrs['st_mtime']))
+    os.replace(partial, dest)
+    return attrs['st_size']
+
+
+def write_files(wtfs, files, epoch, target, cached=True):
+    written = skipped = size = 0
+    for path, attrs in files:
+        result = write_file(wtfs, path, attrs, epoch,
+                            os.path.join(target, path.lstrip('/')), cached)
+        if result is None:
+            skipped += 1
+        else:
+            written += 1
+            size += result
+    return written, skipped, size
+
+
+def _init_writer_process(args):
+    global _writer_wtfs
+    _writer_wtfs = make_wtfs(None, args)
+
+
+def _write_files_in_process(files, epoch, target):
+    return write_files(_writer_wtfs, files, epoch, target)
+
+
+def materialize(wtfs, epoch, target, workers=MATERIALIZE_WORKERS, args=None,
+                out=sys.stderr, cached=True):
+    # Writes an epoch's tree below target. Directories are made as the
+    # tree is walked and batches of files go to a pool of writer threads,
+    # or writer processes each building their own WTFS from args. At most
+    # two batches per writer are queued, so memory stays bounded.
+    if args is None:
+        pool = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix='writer')
+        submit = functools.partial(pool.submit, write_files, wtfs,
+                                   cached=cached)
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_writer_process, initargs=(args,))
+        submit = functools.partial(pool.submit, _write_files_in_process)
+    totals = [0, 0, 0]
+    pending = set()
+    start = last_report = time.perf_counter()
+
+    def report(label):
+        if out is None:
+            return
+        elapsed = time.perf_counter() - start
+        written, skipped, size = totals
+        out.write('{}: {} files written, {} skipped, {:.1f}MB in {:.1f}s, '
+                  '{:.0f} files/s, {:.1f}MB/s\n'.format(
+                      label, written, skipped, size / MB, elapsed,
+                      written / elapsed if elapsed else 0,
+                      size / MB / elapsed if elapsed else 0))
+
+    def collect(futures):
+        for future in futures:
+            for i, value in enumerate(future.result()):
+                totals[i] += value
+
+    with pool:
+        os.makedirs(target, exist_ok=True)
+        batch = []
+        for path, attrs in wtfs.walk(epoch, cached=cached):
+            if stat.S_ISDIR(attrs['st_mode']):
+                os.makedirs(os.path.join(target, path.lstrip('/')),
+                            exist_ok=True)
+                continue
+            batch.append((path, attrs))
+            if len(batch) < MATERIALIZE_BATCH:
+                continue
+            pending.add(submit(batch, epoch, target))
+            batch = []
+            if len(pending) >= 2 * workers:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            if time.perf_counter() - last_report >= REPORT_INTERVAL:
+                last_report = time.perf_counter()
+                report('progress')
+        if batch:
+            pending.add(submit(batch, epoch, target))
+        collect(concurrent.futures.as_completed(pending))
+    report('done')
+    return totals
+
+
+def add_tree_arguments(parser):
+    parser.add_argument('--cache-size', type=int, default=CONTENT_CACHE_BYTES,
+                        help='byte budget for rendered file contents')
+    parser.add_argument('--profile', default='flat',
+                        help='workload preset ({}) or JSON profile file'
+                        .format(', '.join(sorted(WORKLOAD_PROFILES))))
+    parser.add_argument('--depth', type=int,
+                        help='levels of subdirectories below the root')
+    parser.add_argument('--fanout', type=int,
+                        help='subdirectories per directory')
+    parser.add_argument('--content', choices=sorted(CONTENT_GENERATORS),
+                        help='how file contents are made')
+    parser.add_argument('--file-size', type=int,
+                        help='bytes per file for generated contents')
+    parser.add_argument('--render-processes', type=int, default=0,
+                        help='render blocks in this many worker processes')
+    parser.add_argument('--gzip', action='store_true',
+                        help='give each file a gzip compressed .gz twin')
+    parser.add_argument('--block-cache', metavar='FILE',
+                        help='keep rendered blocks in FILE across restarts')
+    parser.add_argument('--block-cache-size', type=int,
+                        default=BLOCK_CACHE_BYTES,
+                        help='bytes of blocks the cache file holds')
+
+
+def make_wtfs(parser, args, **kwargs):
+    # Flags given explicitly override the profile
+    profile = load_profile(args.profile)
+    for name in ('depth', 'fanout', 'content'):
+        if getattr(args, name) is not None:
+            profile[name] = getattr(args, name)
+    if args.file_size is not None:
+        profile['sizes'] = [(1, args.file_size, args.file_size)]
+    if args.render_processes and profile['content'] == 'spam':
+        parser.error('--render-processes needs block based --content')
+    return WTFS(cache_size=args.cache_size, entries=profile['entries'],
+                depth=profile['depth'], fanout=profile['fanout'],
+                generator=make_generator(profile['content'],
+                                         profile.get('sizes')),
+                render_processes=args.render_processes, gzip=args.gzip,
+                block_cache=args.block_cache,
+                block_cache_size=args.block_cache_size, **kwargs)
+
+
+def parse_epochs(value):
+    # A single epoch or an inclusive FIRST:LAST range
+    first, _, last = value.partition(':')
+    try:
+        first, last = int(first), int(last or first)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected EPOCH or FIRST:LAST, got {!r}'.format(value))
+    if last < first:
+        raise argparse.ArgumentTypeError(
+            'range {} ends before it starts'.format(value))
+    return list(range(first, last + 1))
+
+
+def tar_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='wtfs.py tar',
+        description='Write the tree of one or more epochs to stdout as a '
+                    'tar archive, without mounting it.')
+    parser.add_argument('--epochs', type=parse_epochs,
+                        help='epoch or FIRST:LAST range (default: now)')
+    add_tree_arguments(parser)
+    args = parser.parse_args(argv)
+    wtfs = make_wtfs(parser, args)
+    try:
+        export_tar(wtfs, args.epochs or [wtfs.epoch], sys.stdout.buffer)
+    finally:
+        wtfs.destroy('/')
+
+
+def materialize_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='wtfs.py materialize',
+        description='Write the tree of an epoch to real files below a '
+                    'directory. Rerunning it resumes an interrupted run.')
+    parser.add_argument('target')
+    parser.add_argument('--epoch', type=int, help='epoch to write '
+                        '(default: now)')
+    parser.add_argument('--workers', type=int, default=MATERIALIZE_WORKERS,
+                        help='writer threads or processes')
+    parser.add_argument('--processes', action='store_true',
+                        help='write from processes instead of threads')
+    add_tree_arguments(parser)
+    args = parser.parse_args(argv)
+    wtfs = make_wtfs(parser, args)
+    try:
+        materialize(wtfs, args.epoch or wtfs.epoch, args.target,
+                    args.workers, args if args.processes else None)
+    finally:
+        wtfs.destroy('/')
+
+
+COMMANDS = {
+    'tar': tar_main,
+    'materialize': materialize_main,
+}
 
-def main():
-    if len(sys.argv) != 2:
-        print("usage: {} mountpoint".format(sys.argv[0]))
-        sys.exit(1)
-    fuse = FUSE(WTFS(), sys.argv[1])
 
+def main():
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+    parser = argparse.ArgumentParser(
+        epilog='other commands: {} (see wtfs.py COMMAND -h)'.format(
+            ', '.join(sorted(COMMANDS))))
+    parser.add_argument('mountpoint')
+    add_tree_arguments(parser)
+    parser.add_argument('--prefetch-blocks', type=int, default=PREFETCH_BLOCKS,
+                        help='blocks to read ahead of sequential readers')
+    parser.add_argument('--bulk-concurrency', type=int,
+                        default=BULK_CONCURRENCY,
+                        help='reads allowed to render blocks at once')
+    parser.add_argument('--state', metavar='FILE',
+                        help='save listings and cache keys to FILE on '
+                        'unmount and reload them on the next mount')
+    parser.add_argument('--tmpfs', metavar='DIR',
+                        help='materialize each epoch below DIR and serve '
+                        'reads from those files')
+    args = parser.parse_args()
+    wtfs = make_wtfs(parser, args, prefetch_blocks=args.prefetch_blocks,
+                     bulk_concurrency=args.bulk_concurrency,
+                     tmpfs=args.tmpfs, state=args.state)
+    fuse = FUSE(wtfs, args.mountpoint)
 
 WORDS = """
 abbreviation